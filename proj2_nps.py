@@ -3,13 +3,54 @@
 ##### Uniqname: ycding
 #################################
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+import lxml.html
+from lxml.cssselect import CSSSelector
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+import sqlite3
+import functools
+import hashlib
+import zlib
+import threading
+import itertools
+from dataclasses import dataclass
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 import secrets # file that contains your API key
 API_KEY = secrets.API_KEY
 
+# one pooled session so repeated requests reuse their keep-alive connections
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections = 20, pool_maxsize = 20, max_retries = Retry(total = 3, backoff_factor = 0.3))
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+_aiohttp_timeout = aiohttp.ClientTimeout(total = 10) # same limit as the sync session
 
+# shared with the prefetch thread, so every use goes through _cache_lock
+_conn = sqlite3.connect("cache.sqlite", isolation_level = None, check_same_thread = False) # autocommit
+_cache_lock = threading.Lock()
+_conn.execute("PRAGMA journal_mode=WAL")
+_conn.execute("CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v BLOB)")
+
+# compiled once and reused for every site page
+_SEL_NAME = CSSSelector('.Hero-titleContainer.clearfix a')
+_SEL_CATEGORY = CSSSelector('.Hero-designationContainer span.Hero-designation')
+_SEL_LOCALITY = CSSSelector('span[itemprop="addressLocality"]')
+_SEL_REGION = CSSSelector('[itemprop="addressRegion"]')
+_SEL_ZIPCODE = CSSSelector('[itemprop="postalCode"]')
+_SEL_PHONE = CSSSelector('.tel')
+
+# state pages only need the park list; skip building the rest of the page
+_park_strainer = SoupStrainer(id = "parkListResultsArea")
+
+
+@dataclass(slots = True)
 class NationalSite:
     '''a national site
 
@@ -31,17 +72,17 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
-    def __init__(self, name, category = None, address = None, zipcode = None, phone = None):
-        self.name = name
-        self.category = category
-        self.address = address
-        self.zipcode = zipcode
-        self.phone = phone
+    name: str
+    category: str = ""
+    address: str = ""
+    zipcode: str = ""
+    phone: str = ""
 
     def info(self):
-        return self.name + " (" + self.category + ")" + ": " + self.address + " " + self.zipcode
+        return f"{self.name} ({self.category}): {self.address} {self.zipcode}"
 
 
+@functools.lru_cache(maxsize = 1)
 def build_state_url_dict():
     ''' Make a dictionary that maps state name to state page url from "https://www.nps.gov"
 
@@ -58,7 +99,7 @@ def build_state_url_dict():
     base_url = "https://www.nps.gov"
     return_dict = {}
     response = make_url_request_using_cache(base_url)
-    soup = BeautifulSoup(response, 'html.parser')
+    soup = BeautifulSoup(response, 'lxml')
     dropdown_menu = soup.find(class_ = "dropdown-menu SearchBar-keywordSearch")
     li = dropdown_menu.find_all('li')
     for ele in li:
@@ -80,18 +121,60 @@ def get_site_instance(site_url):
     instance
         a national site instance
     '''
-    soup = BeautifulSoup(make_url_request_using_cache(site_url), 'html.parser')
-    title = soup.find(class_ = "Hero-titleContainer clearfix")
-    designation = soup.find(class_ = "Hero-designationContainer")
-
-    name = title.find('a').text
-    category = designation.find('span', class_ = 'Hero-designation').text
-    address = soup.find('span', itemprop = "addressLocality").text + ", " + soup.find(itemprop = 'addressRegion').text
-    zipcode = soup.find(itemprop = "postalCode").text.replace(" ","")
-    phone = soup.find(class_ = "tel").text.replace("\n", "")
+    return parse_site_page(make_url_request_using_cache(site_url))
+
+
+async def get_site_instance_async(session, semaphore, site_url):
+    '''Make an instance from a national site URL without blocking the event loop.
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        The session shared by all requests of one crawl
+    semaphore: asyncio.Semaphore
+        Bounds the number of requests in flight
+    site_url: string
+        The URL for a national site page in nps.gov
+
+    Returns
+    -------
+    instance
+        a national site instance
+    '''
+    return parse_site_page(await _fetch(session, semaphore, site_url))
+
+
+def parse_site_page(html):
+    '''Make an instance from the html of a national site page.
+
+    Parameters
+    ----------
+    html: string
+        The text of a national site page in nps.gov
+
+    Returns
+    -------
+    instance
+        a national site instance
+    '''
+    tree = lxml.html.fromstring(html)
+    name = _first_text(_SEL_NAME, tree)
+    category = _first_text(_SEL_CATEGORY, tree)
+    address = _first_text(_SEL_LOCALITY, tree) + ", " + _first_text(_SEL_REGION, tree)
+    zipcode = _first_text(_SEL_ZIPCODE, tree).replace(" ","")
+    phone = _first_text(_SEL_PHONE, tree).replace("\n", "")
     return NationalSite(name, category, address, zipcode, phone)
 
 
+def _first_text(selector, tree):
+    # text of the first element the selector matches, like soup.find(...).text;
+    # every field is required, so a page without it is not a site page
+    found = selector(tree)
+    if not found:
+        raise ValueError(f"no element matches {selector.css!r}")
+    return found[0].text_content()
+
+
 def get_sites_for_state(state_url):
     '''Make a list of national site instances from a state URL.
     
@@ -105,15 +188,69 @@ def get_sites_for_state(state_url):
     list
         a list of national site instances
     '''
-    return_list = []
-    soup = BeautifulSoup(make_url_request_using_cache(state_url), 'html.parser')
-    park_result_area = soup.find(id = "parkListResultsArea")
-    park_list = park_result_area.find_all('li', class_ = 'clearfix')  
-    for park in park_list:
-        park_name = park.find('h3')
-        park_url = "http://www.nps.gov/" + park_name.find('a')['href'] + "index.htm"
-        return_list.append(get_site_instance(park_url))
-    return return_list
+    return asyncio.run(get_sites_for_state_async(state_url))
+
+
+async def get_sites_for_state_async(state_url):
+    '''Make a list of national site instances from a state URL,
+    fetching all site pages concurrently.
+    
+    Parameters
+    ----------
+    state_url: string
+        The URL for a state page in nps.gov
+    
+    Returns
+    -------
+    list
+        a list of national site instances, in page order
+    '''
+    park_urls = parse_park_urls(make_url_request_using_cache(state_url))
+    semaphore = asyncio.Semaphore(20) # don't hammer nps.gov
+    async with aiohttp.ClientSession(timeout = _aiohttp_timeout) as session:
+        return await asyncio.gather(*[get_site_instance_async(session, semaphore, url) for url in park_urls])
+
+
+def parse_park_urls(html):
+    '''Make a list of national site URLs from the html of a state page.
+    
+    Parameters
+    ----------
+    html: string
+        The text of a state page in nps.gov
+    
+    Returns
+    -------
+    list
+        the URLs of the national sites, in page order, each listed once
+    '''
+    soup = BeautifulSoup(html, 'lxml', parse_only = _park_strainer)
+    if soup.find(id = "parkListResultsArea") is None: # e.g. an error page
+        raise ValueError("no park list on this state page")
+    park_list = soup.find_all('li', class_ = 'clearfix')
+    # nps.gov sometimes lists a park twice; fetch each one once, in page order
+    return list(dict.fromkeys("http://www.nps.gov/" + park.find('h3').find('a')['href'] + "index.htm" for park in park_list))
+
+
+async def prefetch_all_states(state_dictionary):
+    '''Fill the cache with every state page, so that the page of whichever
+    state the user picks is already cached. Failures are ignored; the
+    page is simply fetched again when it is needed.
+    
+    Parameters
+    ----------
+    state_dictionary: dict
+        maps names of all states to their state page urls
+    
+    Returns
+    -------
+    None
+    '''
+    semaphore = asyncio.Semaphore(10)
+    async with aiohttp.ClientSession(timeout = _aiohttp_timeout) as session:
+        # only check that a row exists; decoding cached pages here would be wasted work
+        missing = [url for url in state_dictionary.values() if not is_cached(url)]
+        await asyncio.gather(*[_fetch(session, semaphore, url, quiet = True) for url in missing], return_exceptions = True)
 
 
 def get_nearby_places(site_object):
@@ -132,16 +269,19 @@ def get_nearby_places(site_object):
     dictionary = {"key": API_KEY, "origin": site_object.zipcode, "radius": 10.0, "maxMatches": 10, "ambiguities": "ignore", "outFormat": "json"}
     base_url = "http://www.mapquestapi.com/search/v2/radius"
     request_key = construct_key(base_url, dictionary)
-    CACHE_DICT = use_cache()
-    if request_key in CACHE_DICT:
+    content = get_from_cache(request_key)
+    if content is not None:
         print("Using Cache")
-    else:
-        print("Fetching")
-        CACHE_DICT[request_key] = requests.get(url = base_url, params = dictionary).json()
-        save_cache(CACHE_DICT)
-    return CACHE_DICT[request_key]
+        return _json.loads(content)
+    print("Fetching")
+    response = _session.get(url = base_url, params = dictionary, timeout = 10)
+    response.raise_for_status()
+    result = _json.loads(response.content) # only cache replies that parse
+    add_to_cache(request_key, response.content)
+    return result
 
 
+@functools.lru_cache(maxsize = 4096)
 def make_url_request_using_cache(url):
     '''Use cache to make url request
     
@@ -152,58 +292,119 @@ def make_url_request_using_cache(url):
     
     Returns
     -------
-    CACHE_DICT[url]: str
+    str
         The text of the response of this url
     '''
-    CACHE_DICT = use_cache()
-    if url in CACHE_DICT.keys(): # the url is also the unique key
+    content = get_from_cache(url) # the url is also the unique key
+    if content is not None:
         print("Using Cache")
-    else:
-        print("Fetching")
-        response = requests.get(url)
-        CACHE_DICT[url] = response.text
-        save_cache(CACHE_DICT)
-    return CACHE_DICT[url]
+        return content.decode('utf-8')
+    print("Fetching")
+    response = _session.get(url, timeout = 10)
+    response.raise_for_status() # don't cache error pages
+    # nps.gov is always utf-8, skip encoding detection; decode before
+    # caching so a body that isn't utf-8 never gets stored
+    text = response.content.decode('utf-8')
+    add_to_cache(url, response.content)
+    return text
+
+
+async def _fetch(session, semaphore, url, quiet = False):
+    '''Use cache to make url request from inside the event loop
+    
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        The session used on a cache miss
+    semaphore: asyncio.Semaphore
+        Bounds the number of requests in flight
+    url: str
+        An url that may or may not contained in cache
+    quiet: bool
+        Don't print cache hits and misses (for background fetches)
+    
+    Returns
+    -------
+    str
+        The text of the response of this url
+    '''
+    content = get_from_cache(url)
+    if content is not None:
+        if not quiet:
+            print("Using Cache")
+        return content.decode('utf-8')
+    async with semaphore:
+        if not quiet:
+            print("Fetching")
+        async with session.get(url) as response:
+            response.raise_for_status() # don't cache error pages
+            content = await response.read()
+    text = content.decode('utf-8') # before caching, like make_url_request_using_cache
+    add_to_cache(url, content)
+    return text
+
+
+def get_from_cache(key):
+    ''' Look up one entry in the cache database
+    
+    Parameters
+    ----------
+    key: str
+        The unique key of the entry
+    
+    Returns
+    -------
+    bytes
+        The cached response, or None if the key is not cached
+    '''
+    with _cache_lock:
+        row = _conn.execute("SELECT v FROM cache WHERE k = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    try:
+        return zlib.decompress(row[0])
+    except (zlib.error, TypeError): # stored uncompressed by an older version
+        return None
 
 
-def use_cache():
-    ''' If there is a cache file, open it and loads the JSON into
-    the CACHE_DICT dictionary. If not, create a new cache dictionary
+def is_cached(key):
+    ''' Check whether the cache database has an entry, without reading it
     
     Parameters
     ----------
-    None
+    key: str
+        The unique key of the entry
     
     Returns
     -------
-    cache_dict: dict
+    bool
+        True if the key is cached
     '''
-    try:
-        cache_file = open("cache.json", 'r')
-        cache_read = cache_file.read()
-        cache_dict = json.loads(cache_read)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
+    with _cache_lock:
+        # zlib streams start with 0x78; rows stored uncompressed by an older
+        # version don't, and get_from_cache treats them as misses too
+        return _conn.execute("SELECT 1 FROM cache WHERE k = ? AND substr(v, 1, 1) = x'78'", (key,)).fetchone() is not None
 
 
-def save_cache(cache_dict):
-    ''' Saves the current cache
+def add_to_cache(key, value):
+    ''' Store one entry in the cache database. Only this row is written,
+    so the cost of a miss does not grow with the size of the cache.
+    Values are zlib-compressed; html shrinks about tenfold.
     
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    key: str
+        The unique key of the entry
+    value: bytes
+        The response to cache
     
     Returns
     -------
     None
     '''
-    dump_cache = json.dumps(cache_dict)
-    temp = open("cache.json","w")
-    temp.write(dump_cache)
-    temp.close()
+    value = zlib.compress(value, 6)
+    with _cache_lock:
+        _conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?)", (key, value))
 
 
 def construct_key(baseurl, dictionary):
@@ -219,22 +420,31 @@ def construct_key(baseurl, dictionary):
     Returns
     -------
     string
-        the unique key as a string
+        the unique key, a 32-character hex digest
     '''
-    lis = []
-    for key in dictionary.keys():
-        lis.append(f'{key}_{dictionary[key]}')
-    lis = sorted(lis)
-    return baseurl + '_' + '_'.join(lis)
+    return _construct_key(baseurl, tuple(sorted(dictionary.items())))
 
 
-def print_site_in_state(state_list, park_list, input_value):
+@functools.lru_cache(maxsize = None)
+def _construct_key(baseurl, items):
+    # dicts aren't hashable, so construct_key memoizes on a sorted item tuple
+    h = hashlib.blake2b(digest_size = 16)
+    h.update(baseurl.encode())
+    for key, value in items:
+        h.update(key.encode())
+        h.update(b"=")
+        h.update(str(value).encode())
+        h.update(b"&")
+    return h.hexdigest()
+
+
+def print_site_in_state(state_dictionary, park_list, input_value):
     '''Print the site in one user-selected state
     
     Parameters
     ----------
-    state_list: list
-        a list contains names of all states
+    state_dictionary: dict
+        maps names of all states to their state page urls
     park_list: list
         a list contains names of all parks in the selected state
     input_value: string
@@ -246,7 +456,7 @@ def print_site_in_state(state_list, park_list, input_value):
         a list of names of all parks in the selected state
     '''
     while(True):
-        if input_value in state_list:
+        if input_value in state_dictionary:
             park_list = []
             i = 1
             park_list = get_sites_for_state(state_dictionary[input_value])
@@ -281,35 +491,22 @@ def print_nearby_places(site_object):
     print("-------------------------------------")
     print("Places near", site_object.name)
     print("-------------------------------------") 
-    i = 0 
-    for near_park in near_place_list["searchResults"]:
+    for near_park in itertools.islice(near_place_list["searchResults"], 10):
         near_fields = near_park["fields"]
-        near_name = near_fields["name"]
-        if(near_fields["group_sic_code_name_ext"] != ""):
-            near_category = near_fields["group_sic_code_name_ext"]
-        else:
-            near_category = "no category"
-        if(near_fields["address"] != ""):
-            near_address = near_fields["address"]
-        else:
-            near_address = "no address"
-        if(near_fields["city"] != ""):
-            near_city = near_fields["city"]
-        else:
-            near_city = "no city"
-        i += 1
-        print("- " + near_name + " (" + near_category + "): " + near_address + ", " + near_city)
-        if (i == 10):
-            break
+        near_name = near_fields.get("name") or "no name"
+        near_category = near_fields.get("group_sic_code_name_ext") or "no category"
+        near_address = near_fields.get("address") or "no address"
+        near_city = near_fields.get("city") or "no city"
+        print(f"- {near_name} ({near_category}): {near_address}, {near_city}")
 
 
-def print_near(state_list, park_list):
+def print_near(state_dictionary, park_list):
     '''Print the the near site
     
     Parameters
     ----------
-    state_list: list
-        a list contains names of all states
+    state_dictionary: dict
+        maps names of all states to their state page urls
     park_list: list
         a list contains names of all parks in the selected state
     
@@ -333,7 +530,7 @@ def print_near(state_list, park_list):
         elif(next_input == 'back'):
             print('Enter a state name(e.g. Michigan, michigan) or "exit"')
             input_value = input(": ").lower()
-            park_list = print_site_in_state(state_list, park_list, input_value)
+            park_list = print_site_in_state(state_dictionary, park_list, input_value)
         else:
             print("[Error] Invalid input\n")
 
@@ -341,11 +538,10 @@ def print_near(state_list, park_list):
 if __name__ == "__main__":
     base_url = "https://www.nps.gov/index.htm"
     state_dictionary = build_state_url_dict()
+    # warm the cache with every state page while the user is typing
+    threading.Thread(target = asyncio.run, args = (prefetch_all_states(state_dictionary),), daemon = True).start()
     print('Enter a state name(e.g. Michigan, michigan) or "exit"')
     input_value = input(": ").lower()
-    state_list = []
     park_list = []
-    for state in state_dictionary.keys():
-        state_list.append(state)
-    park_list = print_site_in_state(state_list, park_list, input_value)
-    print_near(state_list, park_list)
\ No newline at end of file
+    park_list = print_site_in_state(state_dictionary, park_list, input_value)
+    print_near(state_dictionary, park_list)
\ No newline at end of file
@@ -1,4 +1,7 @@
 import unittest
+import asyncio
+import sqlite3
+from unittest import mock
 import proj2_nps as nps
 
 # SI 507 Fall 2020
@@ -45,6 +48,33 @@ class Test_Part2(unittest.TestCase):
         self.assertEqual(self.site_wy1.info(), "Yellowstone (National Park): Yellowstone National Park, WY 82190-0168")
 
 
+class Test_Part2_Parsing(unittest.TestCase):
+    def setUp(self):
+        self.site_html = '''<html><body>
+        <div class="Hero-titleContainer clearfix"><a href="/yell/">Yellowstone</a></div>
+        <div class="Hero-designationContainer"><span class="Hero-designation">National Park</span></div>
+        <span itemprop="addressLocality">Yellowstone National Park</span>,
+        <span itemprop="addressRegion">WY</span>
+        <span itemprop="postalCode">82190-0168 </span>
+        <span class="tel">
+307-344-7381</span>
+        </body></html>'''
+
+    def test_2_5_parse_fields(self):
+        site = nps.parse_site_page(self.site_html)
+        self.assertEqual(site.name, "Yellowstone")
+        self.assertEqual(site.category, "National Park")
+        self.assertEqual(site.address, "Yellowstone National Park, WY")
+        self.assertEqual(site.zipcode, "82190-0168")
+        self.assertEqual(site.phone, "307-344-7381")
+
+    def test_2_6_missing_field(self):
+        with self.assertRaises(ValueError):
+            nps.parse_site_page(self.site_html.replace('class="tel"', ''))
+        with self.assertRaises(ValueError):
+            nps.parse_site_page("<html><body><p>404</p></body></html>")
+
+
 class Test_Part3(unittest.TestCase):
     def setUp(self):
         self.wy_list = nps.get_sites_for_state('https://www.nps.gov/state/wy/index.htm')
@@ -64,6 +94,56 @@ class Test_Part3(unittest.TestCase):
         self.assertEqual(self.wy_list[0].info(),"Bighorn Canyon (National Recreation Area): Lovell, WY 82431")
 
 
+class Test_Part3_Duplicates(unittest.TestCase):
+    def setUp(self):
+        self.state_html = '''<html><body><ul class="clearfix"><li class="clearfix">menu</li></ul>
+        <div id="parkListResultsArea"><ul>
+        <li class="clearfix"><h3><a href="/bica/">Bighorn Canyon</a></h3></li>
+        <li class="clearfix"><h3><a href="/yell/">Yellowstone</a></h3></li>
+        <li class="clearfix"><h3><a href="/bica/">Bighorn Canyon</a></h3></li>
+        </ul></div></body></html>'''
+
+    def test_3_4_duplicate_parks(self):
+        self.assertEqual(nps.parse_park_urls(self.state_html),
+            ['http://www.nps.gov//bica/index.htm', 'http://www.nps.gov//yell/index.htm'])
+
+    def test_3_5_page_order(self):
+        # the first park finishes last, but results still follow the page
+        async def fake_site(session, semaphore, site_url):
+            await asyncio.sleep(0.02 if 'bica' in site_url else 0)
+            return site_url
+        with mock.patch.object(nps, "make_url_request_using_cache", return_value = self.state_html), \
+                mock.patch.object(nps, "get_site_instance_async", fake_site):
+            self.assertEqual(nps.get_sites_for_state('https://www.nps.gov/state/wy/index.htm'),
+                ['http://www.nps.gov//bica/index.htm', 'http://www.nps.gov//yell/index.htm'])
+
+
+class Test_Cache(unittest.TestCase):
+    def setUp(self):
+        conn = sqlite3.connect(":memory:", isolation_level = None)
+        conn.execute("CREATE TABLE cache(k TEXT PRIMARY KEY, v BLOB)")
+        patcher = mock.patch.object(nps, "_conn", conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(conn.close)
+
+    def test_cache_round_trip(self):
+        page = "<html>Yellowstone é</html>".encode()
+        nps.add_to_cache("http://page", page)
+        self.assertEqual(nps.get_from_cache("http://page"), page)
+        self.assertTrue(nps.is_cached("http://page"))
+        self.assertIsNone(nps.get_from_cache("http://missing"))
+        self.assertFalse(nps.is_cached("http://missing"))
+
+    def test_cache_uncompressed_row(self):
+        # rows written before values were compressed read as misses
+        nps._conn.execute("INSERT INTO cache VALUES (?, ?)", ("http://text", "<html></html>"))
+        nps._conn.execute("INSERT INTO cache VALUES (?, ?)", ("http://json", b'{"a": 1}'))
+        for key in ("http://text", "http://json"):
+            self.assertIsNone(nps.get_from_cache(key))
+            self.assertFalse(nps.is_cached(key))
+
+
 class Test_Part4(unittest.TestCase):
     def setUp(self):
         self.site_mi2 = nps.get_site_instance('https://www.nps.gov/slbe/index.htm')